@@ -1,7 +1,8 @@
-from urllib import request
 import fastapi
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import PlainTextResponse # Return markdown as plain text
+from fastapi.responses import ORJSONResponse, PlainTextResponse # Return markdown as plain text
+import httpx
+from starlette.formparsers import MultiPartParser
 from mistralai import Mistral # Import both classes directly # Import specific exception
 import os
 import io
@@ -9,9 +10,14 @@ import tempfile
 import logging
 import asyncio
 import gc
-from contextlib import asynccontextmanager
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, suppress
+from typing import BinaryIO, NamedTuple, Optional, Union
 from dotenv import load_dotenv # For local .env loading
 import re
+import hashlib
+from collections import OrderedDict
 
 # --- Configuration ---
 # Load environment variables from .env file for local development
@@ -34,20 +40,153 @@ logger = logging.getLogger(__name__)
 # Create temp directory
 TEMP_DIR = os.path.join(os.getcwd(), 'temp_ocr_files')
 os.makedirs(TEMP_DIR, exist_ok=True)
-logger.info(f"Temporary directory set to: {TEMP_DIR}")
+logger.info("Temporary directory set to: %s", TEMP_DIR)
 
 # Mistral Limits
 MAX_FILE_SIZE_MB_MISTRAL = 50
 MAX_FILE_SIZE_BYTES_MISTRAL = MAX_FILE_SIZE_MB_MISTRAL * 1024 * 1024
+# Allowance for the form around the document: multipart framing plus the /ocr/chat message field
+MULTIPART_OVERHEAD_BYTES = 1024 * 1024
+UPLOAD_PATHS = frozenset({"/ocr/process", "/ocr/chat"})
+
+# Accepted upload types, and the extensions used to infer them for application/octet-stream uploads
+_ALLOWED_CONTENT_TYPES = frozenset({"application/pdf", "image/jpeg", "image/png"})
+_ALLOWED_CONTENT_TYPES_STR = ", ".join(sorted(_ALLOWED_CONTENT_TYPES))
+_EXTENSION_CONTENT_TYPES = {
+    ".pdf": "application/pdf",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+}
+
+# Markdown table: header row, separator row, then any number of body rows (compiled once)
+_TABLE_REGEX = re.compile(r'\|([^\n]+)\|\n\|([-|\s]+)\|\n((?:\|[^\n]+\|\n?)*)')
+
+# OCR output larger than this is scanned for tables on the worker pool instead of the event loop
+TABLE_SCAN_OFFLOAD_CHARS = 100_000
+
+# Temp directory sweeper: removes leftover staging files (e.g. after a crash or OOM kill)
+TEMP_SWEEP_INTERVAL_SECONDS = int(os.environ.get("TEMP_SWEEP_INTERVAL_SECONDS", "300"))
+TEMP_FILE_MAX_AGE_SECONDS = int(os.environ.get("TEMP_FILE_MAX_AGE_SECONDS", "3600"))
+
+# Upload staging
+READ_BUFFER_SIZE = 1024 * 1024 # 1MB reusable read buffer
+
+# Dedicated thread pool for blocking work (upload staging), sized via MISTRAL_POOL_SIZE
+MISTRAL_POOL_SIZE = int(os.environ.get("MISTRAL_POOL_SIZE", "64"))
+
+# Shared HTTP/2 connection pool for the Mistral SDK (keepalive + multiplexing across requests)
+MISTRAL_HTTP_TIMEOUT_SECONDS = 300
+MISTRAL_HTTP_MAX_CONNECTIONS = 128
+MISTRAL_HTTP_MAX_KEEPALIVE = 32
+
+# Chat completion cache (LRU). Set CHAT_CACHE_SIZE=0 to disable.
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", "256"))
+_chat_cache: "OrderedDict[tuple, tuple[str, Optional[dict]]]" = OrderedDict()
+
+# --- Upload Staging ---
+def _file_too_large_error() -> HTTPException:
+    return HTTPException(
+        status_code=413, # Payload Too Large
+        detail=f"File too large: Exceeds Mistral limit of {MAX_FILE_SIZE_MB_MISTRAL}MB"
+    )
+
+def _write_all(fd: int, data) -> None:
+    """os.write until every byte of data is written (os.write may write partially)."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _safe_suffix(filename: Optional[str]) -> str:
+    """Returns the filename's extension for use in a temp file name, or '' if it isn't a plain extension."""
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if re.fullmatch(r"\.[a-z0-9]{1,10}", extension) else ""
+
+def _spool_to_disk(src_file, dst_fd: int, max_bytes: int) -> int:
+    """
+    Copies a (non-seekable) uploaded stream into the open file descriptor dst_fd and
+    returns the number of bytes written. Blocking; run it on app.state.mistral_pool.
+    Reads with readinto() into a single reusable READ_BUFFER_SIZE buffer and writes with os.write.
+    Raises HTTPException(413) once the size exceeds max_bytes.
+    """
+    buf = bytearray(READ_BUFFER_SIZE)
+    view = memoryview(buf)
+    file_size = 0
+    while True:
+        n = src_file.readinto(buf)
+        if not n:
+            return file_size
+        file_size += n
+        if file_size > max_bytes:
+            raise _file_too_large_error()
+        _write_all(dst_fd, view[:n])
+
+
+# --- Temp Directory Sweeper ---
+def _sweep_temp_dir(max_age_seconds: int) -> int:
+    """Removes files in TEMP_DIR older than max_age_seconds. Returns the number removed."""
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass # Already removed by its request
+    return removed
+
+async def _temp_sweeper():
+    """Periodically sweeps TEMP_DIR on the worker pool until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(TEMP_SWEEP_INTERVAL_SECONDS)
+        try:
+            removed = await loop.run_in_executor(app.state.mistral_pool, _sweep_temp_dir, TEMP_FILE_MAX_AGE_SECONDS)
+            if removed:
+                logger.info("Temp sweeper removed %s stale file(s) from %s", removed, TEMP_DIR)
+        except Exception as e:
+            logger.error("Temp sweeper failed: %s", e, exc_info=True)
+
 
 # --- Lifespan Management for Mistral Client ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global mistral_client
+    # The SDK (and httpx underneath it) log every request at DEBUG/INFO
+    logging.getLogger("mistralai").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # Bounded pool so bursts of blocking work don't queue behind the default executor
+    app.state.mistral_pool = ThreadPoolExecutor(max_workers=MISTRAL_POOL_SIZE, thread_name_prefix="mistral")
+    logger.info("Blocking work pool started with %s workers.", MISTRAL_POOL_SIZE)
+
+    app.state.temp_sweeper = asyncio.create_task(_temp_sweeper())
+
+    app.state.httpx_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=MISTRAL_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=MISTRAL_HTTP_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(MISTRAL_HTTP_TIMEOUT_SECONDS),
+    )
+
     logger.info("Application startup: Initializing Mistral client...")
     try:
         if MISTRAL_API_KEY:
-             mistral_client = Mistral(api_key=MISTRAL_API_KEY)
+             try:
+                 # The SDK passes its own per-request timeout (None = unbounded) to httpx,
+                 # so timeout_ms is what actually bounds each call
+                 mistral_client = Mistral(
+                     api_key=MISTRAL_API_KEY,
+                     async_client=app.state.httpx_client,
+                     timeout_ms=MISTRAL_HTTP_TIMEOUT_SECONDS * 1000,
+                 )
+             except TypeError:
+                 logger.warning("Mistral SDK does not accept a shared async_client; using its default HTTP client.")
+                 mistral_client = Mistral(api_key=MISTRAL_API_KEY)
              # Optional: Make a simple test call if needed, e.g., list models
              # models = mistral_client.models.list()
              # logger.info(f"Mistral client initialized successfully. Available models (sample): {models.data[:2]}")
@@ -57,50 +196,78 @@ async def lifespan(app: FastAPI):
              # You might want the app to not fully start in a real scenario
              # For now, it will raise errors when used later.
     except Exception as e:
-        logger.error(f"An unexpected error occurred during Mistral client initialization: {e}", exc_info=True)
+        logger.error("An unexpected error occurred during Mistral client initialization: %s", e, exc_info=True)
+
+    # Move everything allocated during startup (imports, client) out of the GC's
+    # tracked generations so later collections don't keep rescanning it
+    gc.freeze()
 
     yield # Application runs here
 
     logger.info("Application shutdown: Cleaning up resources...")
+    app.state.temp_sweeper.cancel()
     mistral_client = None # Clear reference
-    gc.collect()
+    await app.state.httpx_client.aclose()
+    app.state.mistral_pool.shutdown(wait=False, cancel_futures=True)
 
 
-app = FastAPI(title="Mistral OCR Service", lifespan=lifespan)
+app = FastAPI(title="Mistral OCR Service", lifespan=lifespan, default_response_class=ORJSONResponse)
 
-# --- Synchronous Processing Function ---
-def _perform_mistral_ocr(file_path: str, original_filename: str) -> str:
+class RejectOversizeUploads:
+    """
+    ASGI middleware: answers 413 for an upload whose Content-Length is already over the Mistral
+    limit, before FastAPI spools the form. Chunked uploads fall through to _spool_to_disk's check.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in UPLOAD_PATHS:
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if content_length.isdigit() and \
+                    int(content_length) > MAX_FILE_SIZE_BYTES_MISTRAL + MULTIPART_OVERHEAD_BYTES:
+                logger.warning("Upload rejected before reading: Content-Length %s exceeds Mistral limit of %sMB.", content_length.decode(), MAX_FILE_SIZE_MB_MISTRAL)
+                exc = _file_too_large_error()
+                response = ORJSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(RejectOversizeUploads)
+
+# --- Async Processing Function ---
+async def _perform_mistral_ocr_async(file_obj: Union[bytes, BinaryIO], original_filename: str) -> str:
     """
     Handles uploading to Mistral, getting URL, and performing OCR.
-    Runs in a separate thread via asyncio.to_thread.
+    file_obj is the document's bytes or a BufferedReader positioned at its start.
+    Uses the SDK's async methods so no worker thread is held while Mistral responds.
     """
     global mistral_client
     if not mistral_client:
         logger.error("Mistral client is not available.")
         raise RuntimeError("Mistral client not initialized. Check API key.")
 
-    logger.info(f"Starting Mistral OCR process for: {original_filename} (path: {file_path})")
+    logger.info("Starting Mistral OCR process for: %s", original_filename)
     uploaded_file_info = None
     signed_url_info = None
 
     try:
         # 1. Upload the file to Mistral
-        logger.debug(f"Uploading {original_filename} to Mistral files API...")
-        with open(file_path, "rb") as f:
-            uploaded_file_info = mistral_client.files.upload(
-                file={"file_name": original_filename, "content": f},
-                purpose="ocr"
-            )
-        logger.info(f"File uploaded successfully to Mistral. File ID: {uploaded_file_info.id}")
+        logger.debug("Uploading %s to Mistral files API...", original_filename)
+        uploaded_file_info = await mistral_client.files.upload_async(
+            file={"file_name": original_filename, "content": file_obj},
+            purpose="ocr"
+        )
+        logger.info("File uploaded successfully to Mistral. File ID: %s", uploaded_file_info.id)
 
         # 2. Get the signed URL (Mistral OCR needs a URL)
-        logger.debug(f"Retrieving signed URL for file ID: {uploaded_file_info.id}")
-        signed_url_info = mistral_client.files.get_signed_url(file_id=uploaded_file_info.id)
-        logger.info(f"Signed URL retrieved successfully.")
+        logger.debug("Retrieving signed URL for file ID: %s", uploaded_file_info.id)
+        signed_url_info = await mistral_client.files.get_signed_url_async(file_id=uploaded_file_info.id)
+        logger.info("Signed URL retrieved successfully.")
 
         # 3. Call the OCR process using the signed URL
-        logger.debug(f"Calling Mistral OCR process for URL: {signed_url_info.url[:50]}...") # Log truncated URL
-        ocr_response = mistral_client.ocr.process(
+        logger.debug("Calling Mistral OCR process for URL: %s...", signed_url_info.url[:50]) # Log truncated URL
+        ocr_response = await mistral_client.ocr.process_async(
             model="mistral-ocr-latest", # Use the specified model
             document={
                 "type": "document_url",
@@ -108,7 +275,7 @@ def _perform_mistral_ocr(file_path: str, original_filename: str) -> str:
             }
             # Add include_image_base64=True if needed
         )
-        logger.info(f"Mistral OCR processing completed successfully for {original_filename}.")
+        logger.info("Mistral OCR processing completed successfully for %s.", original_filename)
 
         # Assuming the response structure has the content directly or needs specific access
         # Adjust based on actual mistralai library response structure
@@ -122,51 +289,197 @@ def _perform_mistral_ocr(file_path: str, original_filename: str) -> str:
              # If it's more complex, you might need to serialize parts of it
              # For now, assume it returns a string or has a .content attribute
              # This might need adjustment based on the library's return type for ocr.process
-             logger.warning(f"Unexpected OCR response format: {type(ocr_response)}. Attempting string conversion.")
+             logger.warning("Unexpected OCR response format: %s. Attempting string conversion.", type(ocr_response))
              markdown_content = str(ocr_response) # Fallback, likely needs refinement
 
         return markdown_content
 
     except Exception as e:
-        logger.error(f"Unexpected error during OCR process for {original_filename}: {e}", exc_info=True)
+        logger.error("Unexpected error during OCR process for %s: %s", original_filename, e, exc_info=True)
         raise RuntimeError(f"Unexpected error during OCR: {e}") from e
     finally:
         # Optional: Delete the file from Mistral storage if desired, requires file ID
         if uploaded_file_info:
             try:
-                logger.debug(f"Attempting to delete Mistral file: {uploaded_file_info.id}")
+                logger.debug("Attempting to delete Mistral file: %s", uploaded_file_info.id)
                 # Uncomment below if you want to delete the file after processing
-                # deleted_status = mistral_client.files.delete(file_id=uploaded_file_info.id)
+                # deleted_status = await mistral_client.files.delete_async(file_id=uploaded_file_info.id)
                 # logger.info(f"Mistral file deletion status for {uploaded_file_info.id}: {deleted_status}")
             except Exception as e: # Catch generic Exception FOR NOW
                 # Check the type of the actual exception raised
-                logger.error(f"Mistral interaction error of type {type(e).__name__} for {original_filename}: {e}", exc_info=True)
+                logger.error("Mistral interaction error of type %s for %s: %s", type(e).__name__, original_filename, e, exc_info=True)
                 # Re-raise for now, or handle based on type if you see a pattern
                 raise RuntimeError(f"Mistral interaction failed: {e}") from e
-        gc.collect()
 
 
 # --- Async Wrapper with Timeout ---
-async def process_document_with_timeout(file_path: str, original_filename: str, timeout: int = 300):
+async def process_document_with_timeout(file_obj: Union[bytes, BinaryIO], original_filename: str, timeout: int = 300):
     """
-    Calls the synchronous OCR function in a thread with a timeout.
+    Runs the async OCR chain with a timeout; the chain is cancelled if it expires.
     """
-    logger.info(f"Scheduling Mistral OCR for {original_filename} with timeout {timeout}s")
+    logger.info("Scheduling Mistral OCR for %s with timeout %ss", original_filename, timeout)
     try:
         result = await asyncio.wait_for(
-            asyncio.to_thread(_perform_mistral_ocr, file_path, original_filename),
+            _perform_mistral_ocr_async(file_obj, original_filename),
             timeout=timeout
         )
-        logger.info(f"Successfully processed document in thread: {original_filename}")
+        logger.info("Successfully processed document: %s", original_filename)
         return result
     except asyncio.TimeoutError:
-        logger.error(f"Processing timed out after {timeout} seconds for {original_filename}")
+        logger.error("Processing timed out after %s seconds for %s", timeout, original_filename)
         raise HTTPException(status_code=504, detail=f"OCR processing timed out after {timeout} seconds.")
     except Exception as e:
-        logger.error(f"Error during threaded document processing for {original_filename}: {str(e)}", exc_info=True)
+        # The OCR chain already logged the traceback; only repeat it when debugging
+        logger.error("Error during document processing for %s: %s", original_filename, e, exc_info=logger.isEnabledFor(logging.DEBUG))
         # Check if it's a known error type maybe? For now, wrap it.
         raise HTTPException(status_code=500, detail=f"OCR processing failed: ({type(e).__name__}) {str(e)}")
-    
+
+@contextmanager
+def _sdk_upload_content(src_file: BinaryIO, size: int):
+    """
+    Yields a seekable upload of size bytes in a form the SDK's File.content accepts (bytes
+    or a BufferedReader; SpooledTemporaryFile is rejected by its validation). Uploads Starlette
+    has already rolled over to disk are read through a BufferedReader on the same fd;
+    in-memory spools (at most Starlette's spool size) are passed as bytes.
+    """
+    src_file.seek(0)
+    # Starlette spools each part in a SpooledTemporaryFile(max_size=MultiPartParser.spool_max_size),
+    # which moves to a real file once more than that is written. fileno() on one still in
+    # memory would force that rollover, so only uploads past the threshold use the fd
+    if size > MultiPartParser.spool_max_size:
+        try:
+            fd = src_file.fileno()
+        except (OSError, io.UnsupportedOperation):
+            fd = None
+        if fd is not None:
+            with io.open(fd, "rb", closefd=False) as reader:
+                reader.seek(0)
+                yield reader
+            return
+    yield src_file.read()
+
+def _upload_size(file: UploadFile) -> int:
+    """Returns the size of a seekable upload, preferring the size Starlette recorded while spooling."""
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, os.SEEK_END)
+    return file.file.tell()
+
+async def process_upload_with_timeout(file: UploadFile, timeout: int) -> str:
+    """
+    Runs Mistral OCR on an uploaded file.
+    Seekable uploads (Starlette's SpooledTemporaryFile) are streamed to the SDK directly;
+    only non-seekable streams are staged in TEMP_DIR first.
+    """
+    if file.file.seekable():
+        file_size = _upload_size(file)
+        if file_size > MAX_FILE_SIZE_BYTES_MISTRAL:
+            logger.warning("File rejected: Size exceeds Mistral limit of %sMB.", MAX_FILE_SIZE_MB_MISTRAL)
+            raise _file_too_large_error()
+        logger.info("Received %s (%.2f MB). Sending upload stream to Mistral.", file.filename, file_size / (1024 * 1024))
+        with _sdk_upload_content(file.file, file_size) as content:
+            return await process_document_with_timeout(content, file.filename, timeout=timeout)
+
+    temp_file_path = None
+    try:
+        # Fallback: save the non-seekable upload to a temporary file
+        # The user-supplied name only contributes a sanitized extension
+        temp_fd, temp_file_path = tempfile.mkstemp(prefix="ocr_", suffix=_safe_suffix(file.filename), dir=TEMP_DIR)
+        logger.info("Receiving file: %s. Saving to temp path: %s", file.filename, temp_file_path)
+
+        # Copy off the event loop; the partial file is removed in the finally block on 413
+        try:
+            file_size = await asyncio.get_running_loop().run_in_executor(
+                app.state.mistral_pool, _spool_to_disk, file.file, temp_fd, MAX_FILE_SIZE_BYTES_MISTRAL
+            )
+        except HTTPException:
+            logger.warning("File rejected: Size exceeds Mistral limit of %sMB.", MAX_FILE_SIZE_MB_MISTRAL)
+            raise
+        finally:
+            os.close(temp_fd)
+
+        file_size_mb = file_size / (1024 * 1024)
+        logger.info("Finished writing %.2f MB to %s", file_size_mb, temp_file_path)
+
+        with open(temp_file_path, "rb") as temp_file:
+            return await process_document_with_timeout(temp_file, file.filename, timeout=timeout)
+    finally:
+        # Best-effort removal; anything left behind is cleaned up by the temp sweeper
+        if temp_file_path:
+            with suppress(OSError):
+                os.unlink(temp_file_path)
+
+def _chat_cache_key(messages: list, model: str, agent_id: Optional[str]) -> tuple:
+    """Hashes the exact messages sent to Mistral so the key stays small for large documents."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chat_message in messages:
+        digest.update(chat_message["role"].encode())
+        digest.update(b"\0")
+        digest.update(chat_message["content"].encode())
+        digest.update(b"\0")
+    return (digest.digest(), model, agent_id)
+
+async def complete_chat(messages: list, model: str, agent_id: Optional[str] = None) -> tuple[str, Optional[dict]]:
+    """
+    Sends the chat to Mistral (via the agent when agent_id is set) and returns
+    the assistant message together with any markdown table parsed from it.
+    Results for identical (messages, model, agent) requests are served from an LRU cache.
+    """
+    cache_key = _chat_cache_key(messages, model, agent_id) if CHAT_CACHE_SIZE > 0 else None
+    if cache_key is not None and cache_key in _chat_cache:
+        _chat_cache.move_to_end(cache_key)
+        logger.info("Chat completion served from cache")
+        return _chat_cache[cache_key]
+
+    if agent_id:
+        chat_response = await mistral_client.agents.complete_async(
+            agent_id=agent_id,
+            messages=messages,
+        )
+    else:
+        chat_response = await mistral_client.chat.complete_async(
+            model=model,
+            messages=messages
+        )
+
+    # Extract the assistant's message and parse tables in it for client display
+    assistant_message = chat_response.choices[0].message.content
+    result = (assistant_message, parse_markdown_table(assistant_message))
+
+    if cache_key is not None:
+        _chat_cache[cache_key] = result
+        while len(_chat_cache) > CHAT_CACHE_SIZE:
+            _chat_cache.popitem(last=False)
+    return result
+
+def _resolve_content_type(file: UploadFile) -> str:
+    """
+    Resolve the effective content type of an upload, or raise 415 if unsupported.
+    application/octet-stream uploads (e.g. from our Go backend) are inferred from
+    the file extension, falling back to the X-File-Type header.
+    """
+    content_type = file.content_type
+
+    x_file_type = file.headers.get("x-file-type")
+    if x_file_type:
+        logger.info("Received X-File-Type header: %s", x_file_type)
+
+    if content_type == "application/octet-stream":
+        inferred_type = _EXTENSION_CONTENT_TYPES.get(os.path.splitext(file.filename)[1].lower())
+        if inferred_type is None and x_file_type in _ALLOWED_CONTENT_TYPES:
+            inferred_type = x_file_type
+        if inferred_type:
+            logger.info("Treating %s as %s despite content_type=%s", file.filename, inferred_type, content_type)
+            content_type = inferred_type
+
+    if content_type not in _ALLOWED_CONTENT_TYPES:
+        logger.warning("Invalid file type: %s for file %s", content_type, file.filename)
+        raise HTTPException(
+            status_code=415, # Unsupported Media Type
+            detail=f"Unsupported file type: {content_type}. Allowed types: {_ALLOWED_CONTENT_TYPES_STR}"
+        )
+    return content_type
+
 @app.post("/ocr/chat")
 async def ocr_and_chat_endpoint(file: UploadFile = File(...), message: str = Form(...)):
     """
@@ -183,212 +496,110 @@ async def ocr_and_chat_endpoint(file: UploadFile = File(...), message: str = For
         if not file or not file.filename:
             raise HTTPException(status_code=400, detail="Invalid input: No file provided.")
 
-        # Simple content type check
-        allowed_content_types = ["application/pdf", "image/jpeg", "image/png"]
-        content_type = file.content_type
-        
-        # Check for X-File-Type header - FIXED THIS PART
-        x_file_type = None
-        request = fastapi.Request
-        try:
-            # In FastAPI, file headers are accessed through the file object itself
-            x_file_type = file.headers.get("x-file-type")
-            if x_file_type:
-                logger.info(f"Received X-File-Type header: {x_file_type}")
-        except Exception as e:
-            logger.warning(f"Error accessing headers: {e}")
-        
-        # If content type is octet-stream but filename ends with .pdf, treat as PDF
-        if content_type == "application/octet-stream":
-            if file.filename.lower().endswith('.pdf') or x_file_type == "application/pdf":
-                logger.info(f"Treating {file.filename} as PDF despite content_type={content_type}")
-                content_type = "application/pdf"
-            elif file.filename.lower().endswith(('.jpg', '.jpeg')) or x_file_type == "image/jpeg":
-                logger.info(f"Treating {file.filename} as JPEG despite content_type={content_type}")
-                content_type = "image/jpeg"
-            elif file.filename.lower().endswith('.png') or x_file_type == "image/png":
-                logger.info(f"Treating {file.filename} as PNG despite content_type={content_type}")
-                content_type = "image/png"
+        _resolve_content_type(file)
+
+        # Step 1: Process the document with OCR
+        logger.info("Processing OCR for file: %s", file.filename)
+        processing_timeout = 600 # 10 minutes timeout for OCR processing
+        document_text = await process_upload_with_timeout(file, timeout=processing_timeout)
         
-        if content_type not in allowed_content_types:
-             logger.warning(f"Invalid file type: {content_type} for file {file.filename}")
-             raise HTTPException(
-                status_code=415, # Unsupported Media Type
-                detail=f"Unsupported file type: {content_type}. Allowed types: {', '.join(allowed_content_types)}"
-             )
-
-        temp_file_path = None
-        try:
-            # Save upload to a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file.filename}", dir=TEMP_DIR) as temp_file:
-                temp_file_path = temp_file.name
-                logger.info(f"Receiving file: {file.filename}. Saving to temp path: {temp_file_path}")
-
-                file_size = 0
-                chunk_size = 1024 * 1024 # 1MB chunks
-                while True:
-                    chunk = await file.read(chunk_size)
-                    if not chunk:
-                        break
-                    file_size += len(chunk)
-
-                    # Check size against Mistral limit
-                    if file_size > MAX_FILE_SIZE_BYTES_MISTRAL:
-                         logger.warning(f"File rejected: Size exceeds Mistral limit of {MAX_FILE_SIZE_MB_MISTRAL}MB.")
-                         temp_file.close()
-                         os.unlink(temp_file_path)
-                         temp_file_path = None
-                         raise HTTPException(
-                            status_code=413,
-                            detail=f"File too large: Exceeds Mistral limit of {MAX_FILE_SIZE_MB_MISTRAL}MB"
-                         )
-                    temp_file.write(chunk)
-
-                file_size_mb = file_size / (1024 * 1024)
-                logger.info(f"Finished writing {file_size_mb:.2f} MB to {temp_file_path}")
-
-            # Step 1: Process the document with OCR
-            logger.info(f"Processing OCR for file: {file.filename}")
-            processing_timeout = 600 # 10 minutes timeout for OCR processing
-            document_text = await process_document_with_timeout(
-                temp_file_path,
-                file.filename,
-                timeout=processing_timeout
-            )
-            
-            logger.info(f"OCR extraction successful, now processing chat request")
+        logger.info("OCR extraction successful, now processing chat request")
 
-            # Parse tables in the OCR output
-            ocr_tables = []
-            remaining_text = document_text
-            
-            # Find all tables in the OCR output
-            table_regex = re.compile(r'\|([^\n]+)\|\n\|([-|\s]+)\|\n((?:\|[^\n]+\|\n?)*)')
-            table_matches = list(table_regex.finditer(document_text))
-            
-            if table_matches:
-                logger.info(f"Found {len(table_matches)} tables in OCR output")
-                
-                # Process each table
-                for i, match in enumerate(table_matches):
-                    table_start = match.start()
-                    table_end = match.end()
-                    
-                    # Extract table content
-                    table_content = document_text[table_start:table_end]
-                    
-                    # Parse the table
-                    table_data = parse_markdown_table(table_content)
-                    if table_data:
-                        ocr_tables.append({
-                            "index": i,
-                            "start": table_start,
-                            "end": table_end,
-                            "data": table_data
-                        })
-                
-                # Replace tables with placeholders in the text
-                for table in reversed(ocr_tables):
-                    placeholder = f"[TABLE_{table['index']}]"
-                    remaining_text = (
-                        remaining_text[:table['start']] + 
-                        placeholder + 
-                        remaining_text[table['end']:]
-                    )
-                
-                logger.info(f"Processed {len(ocr_tables)} tables from OCR output")
-
-            # Step 2: Process chat with the extracted text
-            # Get the model from environment variables
-            model = os.environ.get("MISTRAL_MODEL", "mistral-small-2501")
-            agent_id = os.environ.get("MISTRAL_AGENT_ID")
-            logger.info(f"Using Mistral model: {model}")
-
-            # Create formatted user message with document context
-            # Send the processed OCR text with table placeholders
-            formatted_user_message = f"Document Content:\n\n{remaining_text}\n\nUser Question: {message}"
-            
-            # Add information about tables if they exist
-            if ocr_tables:
-                table_info = "\n\nThis document contains the following tables:\n"
-                for i, table in enumerate(ocr_tables):
-                    headers = ", ".join(table['data']['headers'])
-                    table_info += f"Table {i+1}: {headers}\n"
-                formatted_user_message += table_info
-
-            # Check if we have an agent ID
-            if agent_id:
-                logger.info(f"Using agent with ID: {agent_id}")
-                # When using an agent, we only need a user message
-                messages = [
-                    {
-                        "role": "user",
-                        "content": formatted_user_message
-                    }
-                ]
-                
-                # Make the API call with agent
-                chat_response = mistral_client.agents.complete(
-                    agent_id=agent_id,
-                    messages=messages,
-                )
-            else:
-                logger.info("No agent ID found, using standard chat")
-                # Standard chat with system and user messages
-                messages = [
-                    {
-                        "role": "system",
-                        "content": "You are an expert consultant helping with document analysis. Use the document content to answer user questions as accurately as possible. If the document doesn't contain information needed to answer the question, be honest about it. When referring to tables, use the table numbers provided."
-                    },
-                    {
-                        "role": "user",
-                        "content": formatted_user_message
-                    }
-                ]
-                
-                # Make the API call without agent
-                chat_response = mistral_client.chat.complete(
-                    model=model,
-                    messages=messages
-                )
-            
-            # Extract the assistant's message
-            assistant_message = chat_response.choices[0].message.content
-            
-            # Parse tables in the response for client display
-            table = parse_markdown_table(assistant_message)
-            
-            # Create response object
-            result = {
-                "response": assistant_message,
-            }
-            
-            # Add table if found in the response
-            if table:
-                result["table"] = table
-            
-            # Add OCR tables if they exist
-            if ocr_tables:
-                result["ocr_tables"] = [table["data"] for table in ocr_tables]
-            
-            logger.info(f"Chat completion successful, response length: {len(assistant_message)}")
-            return result
+        # Parse tables in the OCR output and replace them with placeholders
+        # in a single pass: slices and placeholders are joined once at the end
+        if len(document_text) >= TABLE_SCAN_OFFLOAD_CHARS:
+            table_spans = await asyncio.get_running_loop().run_in_executor(
+                app.state.mistral_pool, _scan_tables, document_text
+            )
+        else:
+            table_spans = _scan_tables(document_text)
+
+        ocr_tables = []
+        parts = []
+        last_end = 0
+        for i, table_span in enumerate(table_spans):
+            parts.append(document_text[last_end:table_span.start])
+            parts.append(f"[TABLE_{i}]")
+            last_end = table_span.end
+            ocr_tables.append({
+                "index": i,
+                "data": {
+                    "headers": table_span.headers,
+                    "rows": table_span.rows
+                }
+            })
+        parts.append(document_text[last_end:])
+        remaining_text = "".join(parts)
+
+        if ocr_tables:
+            logger.info("Processed %s tables from OCR output", len(ocr_tables))
+
+        # Step 2: Process chat with the extracted text
+        # Get the model from environment variables
+        model = os.environ.get("MISTRAL_MODEL", "mistral-small-2501")
+        agent_id = os.environ.get("MISTRAL_AGENT_ID")
+        logger.info("Using Mistral model: %s", model)
 
-        finally:
-            # Ensure temporary file is always deleted
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.unlink(temp_file_path)
-                    logger.info(f"Temporary file removed: {temp_file_path}")
-                except Exception as e:
-                    logger.error(f"CRITICAL: Failed to remove temporary file {temp_file_path}: {e}", exc_info=True)
-            gc.collect()
+        # Create formatted user message with document context
+        # Send the processed OCR text with table placeholders
+        formatted_user_message = f"Document Content:\n\n{remaining_text}\n\nUser Question: {message}"
+        
+        # Add information about tables if they exist
+        if ocr_tables:
+            table_info = "\n\nThis document contains the following tables:\n"
+            for i, table in enumerate(ocr_tables):
+                headers = ", ".join(table['data']['headers'])
+                table_info += f"Table {i+1}: {headers}\n"
+            formatted_user_message += table_info
+
+        # Check if we have an agent ID
+        if agent_id:
+            logger.info("Using agent with ID: %s", agent_id)
+            # When using an agent, we only need a user message
+            messages = [
+                {
+                    "role": "user",
+                    "content": formatted_user_message
+                }
+            ]
+        else:
+            logger.info("No agent ID found, using standard chat")
+            # Standard chat with system and user messages
+            messages = [
+                {
+                    "role": "system",
+                    "content": "You are an expert consultant helping with document analysis. Use the document content to answer user questions as accurately as possible. If the document doesn't contain information needed to answer the question, be honest about it. When referring to tables, use the table numbers provided."
+                },
+                {
+                    "role": "user",
+                    "content": formatted_user_message
+                }
+            ]
+
+        # Make the API call (with agent if configured)
+        assistant_message, table = await complete_chat(messages, model, agent_id)
+        
+        # Create response object
+        result = {
+            "response": assistant_message,
+        }
+        
+        # Add table if found in the response
+        if table:
+            result["table"] = table
+        
+        # Add OCR tables if they exist
+        if ocr_tables:
+            result["ocr_tables"] = [table["data"] for table in ocr_tables]
+        
+        logger.info("Chat completion successful, response length: %s", len(assistant_message))
+        return result
             
     except HTTPException as http_exc:
         # Re-raise HTTP exceptions directly
         raise http_exc
     except Exception as e:
-        logger.error(f"Error in ocr_and_chat_endpoint: {str(e)}", exc_info=True)
+        logger.error("Error in ocr_and_chat_endpoint: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
     
 
@@ -416,14 +627,14 @@ async def chat_with_document_endpoint(request: fastapi.Request):
         if not user_message:
             raise HTTPException(status_code=400, detail="Missing user_message in request")
         
-        logger.info(f"Processing chat with document. User message: {user_message[:50]}...")
+        logger.info("Processing chat with document. User message: %s...", user_message[:50])
         
         # Create formatted user message with document context
         formatted_user_message = f"Document Content:\n\n{document_text}\n\nUser Question: {user_message}"
         
         # Get the model from environment variables
         model = os.environ.get("MISTRAL_MODEL", "mistral-small-2501")
-        logger.info(f"Using Mistral model: {model}")
+        logger.info("Using Mistral model: %s", model)
         
         # Prepare messages
         messages = [
@@ -437,17 +648,8 @@ async def chat_with_document_endpoint(request: fastapi.Request):
             }
         ]
         
-        # Make the API call
-        chat_response = mistral_client.chat.complete(
-            model=model,
-            messages=messages
-        )
-        
-        # Extract the assistant's message
-        assistant_message = chat_response.choices[0].message.content
-        
-        # Parse tables in the response
-        table = parse_markdown_table(assistant_message)
+        # Make the API call and parse tables in the response
+        assistant_message, table = await complete_chat(messages, model)
         
         # Create response object
         result = {
@@ -458,38 +660,124 @@ async def chat_with_document_endpoint(request: fastapi.Request):
         if table:
             result["table"] = table
         
-        logger.info(f"Chat completion successful, response length: {len(assistant_message)}")
+        logger.info("Chat completion successful, response length: %s", len(assistant_message))
         return result
         
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
-        logger.error(f"Error in chat_with_document_endpoint: {str(e)}", exc_info=True)
+        logger.error("Error in chat_with_document_endpoint: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Chat processing failed: {str(e)}")
     
+class TableSpan(NamedTuple):
+    """A markdown table found in a document: character offsets plus parsed cells."""
+    start: int
+    end: int
+    headers: list[str]
+    rows: list[list[str]]
+
+def _is_table_line(line: str) -> bool:
+    return len(line) >= 3 and line[0] == '|' and line[-1] == '|'
+
+def _is_separator_fill(line: str) -> bool:
+    # Only dashes, pipes and whitespace (blank lines included), like _TABLE_REGEX's [-|\s]+
+    return not line.strip('-| \t\r\f\v')
+
+def _split_cells(line: str) -> list[str]:
+    # Strip each cell once and drop the empty ones (including the outer pipes)
+    return [cell for cell in map(str.strip, line.split('|')) if cell]
+
+def _scan_tables(text: str) -> list[TableSpan]:
+    """
+    Finds all markdown tables in text with a single linear pass over its lines
+    (header row, separator row, then contiguous |...| rows), without regex
+    backtracking. Matches what _TABLE_REGEX finds, except that a table must start
+    at the beginning of a line:
+    - the separator may run over several lines, blank ones included, as long as
+      it starts with '|' and its last line ends with '|' and a newline;
+    - a body row runs to the last '|' on its line; text after that pipe (e.g. '\r')
+      is not part of the table and ends it.
+    Returns the offsets needed to splice placeholders into the text.
+    """
+    lines = text.split('\n')
+    line_count = len(lines)
+
+    # line_starts[i] is the offset of line i; line_starts[line_count] is one past the end
+    line_starts = [0] * (line_count + 1)
+    offset = 0
+    for i, line in enumerate(lines):
+        line_starts[i] = offset
+        offset += len(line) + 1
+    line_starts[line_count] = offset
+
+    tables = []
+    i = 0
+    # The separator must be newline-terminated, so a table needs a line after it
+    while i + 2 < line_count:
+        if not _is_table_line(lines[i]) or lines[i + 1][:1] != '|':
+            i += 1
+            continue
+
+        # The separator ends at the last line of the run that ends with '|'
+        # and is followed by a newline (the regex backtracks to the same place)
+        separator_end = None
+        j = i + 1
+        while j + 1 < line_count and _is_separator_fill(lines[j]):
+            if lines[j][-1:] == '|':
+                separator_end = j
+            j += 1
+        # '|', at least one fill character, then the closing '|'
+        if separator_end is None or \
+                line_starts[separator_end] + len(lines[separator_end]) - line_starts[i + 1] < 3:
+            i += 1
+            continue
+
+        rows = []
+        j = separator_end + 1
+        end = line_starts[j]
+        while j < line_count:
+            line = lines[j]
+            last_pipe = line.rfind('|')
+            if line[:1] != '|' or last_pipe < 2:
+                break
+            row = _split_cells(line[:last_pipe + 1])
+            if row:
+                rows.append(row)
+            if last_pipe + 1 < len(line):
+                end = line_starts[j] + last_pipe + 1
+                break
+            j += 1
+            end = min(line_starts[j], len(text))
+
+        tables.append(TableSpan(
+            start=line_starts[i],
+            end=end,
+            headers=_split_cells(lines[i]),
+            rows=rows
+        ))
+        i = j
+    return tables
+
 def parse_markdown_table(content: str):
     """
     Parse markdown tables in the content.
     Returns a dict with headers and rows if a table is found, otherwise None.
     """
     # Look for markdown table in the content
-    table_regex = re.compile(r'\|([^\n]+)\|\n\|([-|\s]+)\|\n((?:\|[^\n]+\|\n?)*)')
-    match = table_regex.search(content)
+    match = _TABLE_REGEX.search(content)
     
     if not match:
         return None
     
     # Parse headers
     header_row = match.group(1).strip()
-    headers = [header.strip() for header in header_row.split('|') if header.strip()]
+    headers = _split_cells(header_row)
     
     # Parse rows
     rows_text = match.group(3).strip()
     rows = []
-    for row_text in rows_text.split('\n'):
-        if not row_text.strip():
-            continue
-        row = [cell.strip() for cell in row_text.split('|') if cell.strip()]
+    for row_text in rows_text.splitlines():
+        row = _split_cells(row_text)
         if row:
             rows.append(row)
     
@@ -508,75 +796,14 @@ async def process_document_endpoint(file: UploadFile = File(...)):
     if not file or not file.filename:
         raise HTTPException(status_code=400, detail="Invalid input: No file provided.")
 
-    # Simple content type check (can be expanded)
-    allowed_content_types = ["application/pdf", "image/jpeg", "image/png"]
-    content_type = file.content_type
-    
-    # Check for X-File-Type header from our Go backend
-    x_file_type = None
-    if 'x-file-type' in file.headers:
-        x_file_type = file.headers['x-file-type']
-        logger.info(f"Received X-File-Type header: {x_file_type}")
-    
-    # If content type is octet-stream but filename ends with .pdf, treat as PDF
-    if content_type == "application/octet-stream":
-        if file.filename.lower().endswith('.pdf') or x_file_type == "application/pdf":
-            logger.info(f"Treating {file.filename} as PDF despite content_type={content_type}")
-            content_type = "application/pdf"
-        elif file.filename.lower().endswith(('.jpg', '.jpeg')) or x_file_type == "image/jpeg":
-            logger.info(f"Treating {file.filename} as JPEG despite content_type={content_type}")
-            content_type = "image/jpeg"
-        elif file.filename.lower().endswith('.png') or x_file_type == "image/png":
-            logger.info(f"Treating {file.filename} as PNG despite content_type={content_type}")
-            content_type = "image/png"
-    
-    if content_type not in allowed_content_types:
-         logger.warning(f"Invalid file type: {content_type} for file {file.filename}")
-         raise HTTPException(
-            status_code=415, # Unsupported Media Type
-            detail=f"Unsupported file type: {content_type}. Allowed types: {', '.join(allowed_content_types)}"
-         )
+    _resolve_content_type(file)
 
-    temp_file_path = None
     try:
-        # Save upload to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file.filename}", dir=TEMP_DIR) as temp_file:
-            temp_file_path = temp_file.name
-            logger.info(f"Receiving file: {file.filename}. Saving to temp path: {temp_file_path}")
-
-            file_size = 0
-            chunk_size = 1024 * 1024 # 1MB chunks
-            while True:
-                chunk = await file.read(chunk_size)
-                if not chunk:
-                    break
-                file_size += len(chunk)
-
-                # Check size against Mistral limit WHILE writing chunks
-                if file_size > MAX_FILE_SIZE_BYTES_MISTRAL:
-                     logger.warning(f"File rejected: Size exceeds Mistral limit of {MAX_FILE_SIZE_MB_MISTRAL}MB.")
-                     # Need to close and delete the partially written temp file
-                     temp_file.close()
-                     os.unlink(temp_file_path)
-                     temp_file_path = None # Ensure finally block doesn't try to delete again
-                     raise HTTPException(
-                        status_code=413, # Payload Too Large
-                        detail=f"File too large: Exceeds Mistral limit of {MAX_FILE_SIZE_MB_MISTRAL}MB"
-                     )
-                temp_file.write(chunk)
-
-            file_size_mb = file_size / (1024 * 1024)
-            logger.info(f"Finished writing {file_size_mb:.2f} MB to {temp_file_path}")
-
-        # Process the temporary file (adjust timeout as needed)
+        # Process the upload (adjust timeout as needed)
         processing_timeout = 600 # 10 minutes, adjust based on typical Mistral processing times
-        markdown_result = await process_document_with_timeout(
-            temp_file_path,
-            file.filename,
-            timeout=processing_timeout
-        )
+        markdown_result = await process_upload_with_timeout(file, timeout=processing_timeout)
 
-        logger.info(f"Successfully processed {file.filename}. Returning markdown content.")
+        logger.info("Successfully processed %s. Returning markdown content.", file.filename)
         # Return as plain text markdown
         return PlainTextResponse(content=markdown_result)
 
@@ -584,17 +811,8 @@ async def process_document_endpoint(file: UploadFile = File(...)):
         # Re-raise HTTP exceptions directly
         raise http_exc
     except Exception as e:
-        logger.error(f"Unhandled error in process_document_endpoint for {file.filename}: {str(e)}", exc_info=True)
+        logger.error("Unhandled error in process_document_endpoint for %s: %s", file.filename, e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
-    finally:
-        # Ensure temporary file is always deleted
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.unlink(temp_file_path)
-                logger.info(f"Temporary file removed: {temp_file_path}")
-            except Exception as e:
-                logger.error(f"CRITICAL: Failed to remove temporary file {temp_file_path}: {e}", exc_info=True)
-        gc.collect()
 
 
 @app.get("/health")
@@ -604,7 +822,7 @@ async def health_check():
     status = "healthy"
     if not mistral_client:
         status = "degraded: Mistral API client not initialized"
-    logger.debug(f"Health check requested. Status: {status}")
+    logger.debug("Health check requested. Status: %s", status)
     return {"status": status}
 
 @app.get("/")
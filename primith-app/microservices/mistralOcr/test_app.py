@@ -0,0 +1,234 @@
+"""
+Smoke tests for the OCR endpoints. Mistral is mocked at the httpx transport, so the
+real SDK request/response validation runs end to end.
+Run from this directory with: python -m pytest -q
+"""
+import asyncio
+import io
+import json
+import os
+import tempfile
+
+os.environ.setdefault("MISTRAL_API_KEY", "test-key")
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import app as app_module
+
+PDF_BYTES = b"%PDF-1.4\n" + b"0" * 4096 + b"\n%%EOF\n"
+OCR_MARKDOWN = "# Report\n\n|Name|Value|\n|---|---|\n|a|1|\n"
+
+
+def _mistral_handler(uploads, chat_requests):
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if request.method == "POST" and path == "/v1/files":
+            body = request.read()
+            uploads.append(body)
+            return httpx.Response(200, json={
+                "id": "file-1",
+                "object": "file",
+                "bytes": len(body),
+                "created_at": 0,
+                "filename": "doc.pdf",
+                "purpose": "ocr",
+                "sample_type": "ocr_input",
+                "source": "upload",
+            })
+        if request.method == "GET" and path == "/v1/files/file-1/url":
+            return httpx.Response(200, json={"url": "https://files.example/doc.pdf"})
+        if request.method == "POST" and path == "/v1/ocr":
+            return httpx.Response(200, json={
+                "pages": [{"index": 0, "markdown": OCR_MARKDOWN, "images": [], "dimensions": None}],
+                "model": "mistral-ocr-latest",
+                "usage_info": {"pages_processed": 1},
+            })
+        if request.method == "POST" and path == "/v1/chat/completions":
+            chat_requests.append(json.loads(request.read()))
+            return httpx.Response(200, json={
+                "id": "chat-1",
+                "object": "chat.completion",
+                "model": "mistral-small-2501",
+                "created": 0,
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "The value is 1."},
+                    "finish_reason": "stop",
+                }],
+            })
+        return httpx.Response(404, json={"detail": f"unexpected {request.method} {path}"})
+    return handler
+
+
+@pytest.fixture
+def client_and_uploads(monkeypatch):
+    uploads = []
+    chat_requests = []
+    real_async_client = httpx.AsyncClient
+    transport = httpx.MockTransport(_mistral_handler(uploads, chat_requests))
+    monkeypatch.setattr(
+        app_module.httpx, "AsyncClient",
+        lambda **kwargs: real_async_client(transport=transport, **kwargs),
+    )
+    with TestClient(app_module.app) as client:
+        yield client, uploads, chat_requests
+
+
+# Small uploads stay in Starlette's in-memory spool; large ones are rolled over to disk
+@pytest.mark.parametrize("pdf_bytes", [PDF_BYTES, PDF_BYTES * 1024], ids=["in-memory", "on-disk"])
+def test_ocr_process_uploads_file_to_mistral(client_and_uploads, pdf_bytes):
+    client, uploads, _ = client_and_uploads
+    response = client.post("/ocr/process", files={"file": ("doc.pdf", pdf_bytes, "application/pdf")})
+
+    assert response.status_code == 200, response.text
+    assert "mistral-ocr-latest" in response.text
+    assert len(uploads) == 1 and pdf_bytes in uploads[0]
+
+
+def test_ocr_chat_returns_assistant_message(client_and_uploads):
+    client, uploads, _ = client_and_uploads
+    response = client.post(
+        "/ocr/chat",
+        files={"file": ("doc.pdf", PDF_BYTES, "application/pdf")},
+        data={"message": "What is the value?"},
+    )
+
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body["response"] == "The value is 1."
+    assert len(uploads) == 1 and PDF_BYTES in uploads[0]
+
+
+def test_parse_markdown_table_matches_table_after_leading_text():
+    table = app_module.parse_markdown_table("ans |x|y|\n|---|---|\n|1|2|\n")
+
+    assert table == {"headers": ["x", "y"], "rows": [["1", "2"]]}
+
+
+def test_ocr_chat_replaces_tables_with_placeholders(client_and_uploads, monkeypatch):
+    client, _, chat_requests = client_and_uploads
+    document = (
+        "Intro\n"
+        "|Name|Value|\n|---|---|\n|a|1|\n"
+        "Between\n"
+        "|Year|\n|---|\n|2024|"
+    )
+
+    async def fake_ocr(file, timeout):
+        return document
+    monkeypatch.setattr(app_module, "process_upload_with_timeout", fake_ocr)
+
+    response = client.post(
+        "/ocr/chat",
+        files={"file": ("doc.pdf", PDF_BYTES, "application/pdf")},
+        data={"message": "Summarize the tables."},
+    )
+
+    assert response.status_code == 200, response.text
+    assert response.json()["ocr_tables"] == [
+        {"headers": ["Name", "Value"], "rows": [["a", "1"]]},
+        {"headers": ["Year"], "rows": [["2024"]]},
+    ]
+    user_message = chat_requests[-1]["messages"][-1]["content"]
+    assert "Document Content:\n\nIntro\n[TABLE_0]Between\n[TABLE_1]\n\nUser Question: Summarize the tables." in user_message
+    assert "Table 1: Name, Value\nTable 2: Year\n" in user_message
+
+
+def _regex_tables(text):
+    return [(m.start(), m.end()) for m in app_module._TABLE_REGEX.finditer(text)]
+
+
+def test_scan_tables_offsets_headers_and_rows():
+    text = "Intro\n| Name | Value |\n|---|---|\n| a | 1 |\n|b|2|\nOutro\n"
+
+    (table,) = app_module._scan_tables(text)
+
+    assert text[table.start:table.end] == "| Name | Value |\n|---|---|\n| a | 1 |\n|b|2|\n"
+    assert table.headers == ["Name", "Value"]
+    assert table.rows == [["a", "1"], ["b", "2"]]
+
+
+def test_scan_tables_table_at_end_of_text():
+    text = "Intro\n|x|y|\n|---|---|\n|1|2|"
+
+    (table,) = app_module._scan_tables(text)
+
+    assert (table.start, table.end) == (6, len(text))
+    assert table.rows == [["1", "2"]]
+
+
+@pytest.mark.parametrize("text", [
+    "|x|y|\n|---|---|",
+    "|x|y|\n|---|---|\n",
+    "|x|y|\nnot a separator\n|1|2|\n",
+], ids=["unterminated-separator", "no-rows", "no-separator"])
+def test_scan_tables_matches_regex_without_table(text):
+    tables = [(t.start, t.end) for t in app_module._scan_tables(text)]
+
+    assert tables == _regex_tables(text)
+
+
+@pytest.mark.parametrize("text", [
+    "|x|y|\n|---|---|\n|1|2|\r\n|3|4|\n",
+    "|x|y|\n|---|---|\n|1|2| note\n|3|4|\n",
+    "|x|y|\n|---|\n\n|---|\n|1|2|\n",
+    "|x|\n|-|\n|1|\n\n|y|\n|-|\n|2|\n",
+], ids=["row-then-cr", "row-then-text", "separator-over-blank-line", "two-tables"])
+def test_scan_tables_matches_regex_offsets(text):
+    tables = [(t.start, t.end) for t in app_module._scan_tables(text)]
+
+    assert tables and tables == _regex_tables(text)
+
+
+def _call_upload_guard(path, content_length):
+    """Runs RejectOversizeUploads around an app that records whether it was reached."""
+    reached, sent = [], []
+
+    async def inner_app(scope, receive, send):
+        reached.append(scope["path"])
+
+    async def receive():
+        raise AssertionError("the request body must not be read")
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path,
+             "headers": [(b"content-length", str(content_length).encode())]}
+    asyncio.run(app_module.RejectOversizeUploads(inner_app)(scope, receive, send))
+    return reached, sent
+
+
+def test_upload_guard_rejects_oversize_content_length():
+    reached, sent = _call_upload_guard("/ocr/process", app_module.MAX_FILE_SIZE_BYTES_MISTRAL * 2)
+
+    assert reached == []
+    assert sent[0]["status"] == 413
+
+
+@pytest.mark.parametrize("path, content_length", [
+    ("/ocr/process", 1024),
+    ("/health", 10 ** 12),
+])
+def test_upload_guard_passes_other_requests_through(path, content_length):
+    reached, sent = _call_upload_guard(path, content_length)
+
+    assert reached == [path]
+    assert sent == []
+
+
+@pytest.mark.parametrize("size, content_type", [
+    (1024, bytes),
+    (2 * 1024 * 1024, io.BufferedReader),
+], ids=["in-memory", "on-disk"])
+def test_sdk_upload_content_type_follows_starlette_spool_threshold(size, content_type):
+    data = b"x" * size
+    # Same spool Starlette uses for a multipart part
+    with tempfile.SpooledTemporaryFile(max_size=app_module.MultiPartParser.spool_max_size) as spool:
+        spool.write(data)
+        with app_module._sdk_upload_content(spool, size) as content:
+            assert isinstance(content, content_type)
+            assert (content if content_type is bytes else content.read()) == data
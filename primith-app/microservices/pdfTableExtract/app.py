@@ -1,40 +1,170 @@
 import fastapi
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import Response, FileResponse, JSONResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from gmft.auto import TableDetector, AutoTableFormatter # Assuming these exist
 from gmft.pdf_bindings import PyPDFium2Document # Assuming these exist
-from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.styles import Alignment
+import xlsxwriter
+import numpy as np
 import pandas as pd
+import torch # Installed with gmft
 from urllib.parse import quote_plus
-import io
 import tempfile
+import uuid
 import logging
 import os
+import re
 import asyncio
 import gc # Garbage Collector
+import ctypes
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, suppress
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s')
+# LOG_LEVEL=DEBUG turns on the per-page/per-table traces; INFO keeps only per-request milestones
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Optimized Table Extraction Service")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Bounded thread pool for whole-PDF jobs, separate from Starlette's shared threadpool
+    app.state.pdf_pool = ThreadPoolExecutor(max_workers=PDF_JOB_THREADS, thread_name_prefix="pdf-job")
+    # Requests queue here, before their timeout starts, rather than inside the executor;
+    # a slot is given back only when its job thread finishes
+    app.state.pdf_job_slots = asyncio.Semaphore(PDF_JOB_THREADS)
+    # Load the models once at startup: each page worker process gets its own
+    # detector/formatter instance, so no per-request init and no shared-model locking
+    pool = _get_page_pool()
+    try:
+        # One task per worker makes the pool start all of its processes now
+        await asyncio.gather(
+            *(asyncio.wrap_future(pool.submit(_warm_page_worker)) for _ in range(PDF_PAGE_WORKERS))
+        )
+        logger.info("Page worker pool warmed up.")
+        # Everything alive after startup (imported libraries, app objects) lives for the
+        # process lifetime; keep it out of every future collection
+        gc.freeze()
+    except Exception as e:
+        # Keep serving; the pool is recreated (and models loaded) on the next request
+        logger.error(f"Failed to load models at startup: {e}", exc_info=True)
+        _discard_page_pool(pool)
+
+    yield # Application runs here
+
+    logger.info("Application shutdown: Stopping page workers...")
+    app.state.pdf_pool.shutdown(wait=False)
+    _shutdown_page_pool()
+
+app = FastAPI(title="Optimized Table Extraction Service", lifespan=lifespan)
 
 # Create temp directory if it doesn't exist
 TEMP_DIR = os.path.join(os.getcwd(), 'temp_pdf_extract')
 os.makedirs(TEMP_DIR, exist_ok=True)
 logger.info(f"Temporary directory set to: {TEMP_DIR}")
 
+# Table cells are held as Arrow-backed strings (requires pyarrow)
+ARROW_STRING = "string[pyarrow]"
+
+# Cell cleanup patterns, compiled once: whole-cell 'None'/'nan' (anchored so 'not None' is kept)
+# and the literal '\\n' gmft uses for line breaks inside a cell
+_BLANK_CELL_RE = re.compile(r'\A(?:None|nan)\Z')
+_NL_RE = re.compile(r'\\n')
+
+# uvicorn server processes (uvicorn reads WEB_CONCURRENCY as its --workers default); each one
+# runs its own page pool and job threads, so the CPU-based defaults below use this process's share
+SERVER_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+CPU_SHARE = max(1, (os.cpu_count() or 1) // SERVER_WORKERS)
+# Pages are detected/formatted in parallel worker processes, each holding its own copy of the models
+PDF_PAGE_WORKERS = int(os.environ.get("PDF_PAGE_WORKERS", str(min(4, CPU_SHARE))))
+# Torch intra-op threads per page worker, so the workers together don't oversubscribe the CPU
+TORCH_THREADS_PER_WORKER = max(1, CPU_SHARE // PDF_PAGE_WORKERS)
+# Whole-PDF job timeout; past it the request gets a 504
+PROCESSING_TIMEOUT_SECONDS = 600
+# Chunk size for copying an upload to its temp file
+UPLOAD_COPY_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_FILE_SIZE_MB = 25
+MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+# Multipart boundary and part headers sent around the PDF
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# Concurrent whole-PDF jobs (each one dispatches pages to the worker pool and writes the workbook);
+# each holds its page results and workbook in memory, so requests beyond this wait their turn
+PDF_JOB_THREADS = int(os.environ.get("PDF_JOB_THREADS", str(max(1, CPU_SHARE // 2))))
+# Resident size above which freed heap memory is handed back to the OS after a request
+MALLOC_TRIM_RSS_MB = int(os.environ.get("MALLOC_TRIM_RSS_MB", "500"))
+# Growth since the last trim needed before trimming again; a warmed-up process may sit above
+# MALLOC_TRIM_RSS_MB for good, and trimming on every request would then be wasted work
+MALLOC_TRIM_GROWTH_MB = int(os.environ.get("MALLOC_TRIM_GROWTH_MB", "100"))
+
+# glibc keeps freed arenas mapped; malloc_trim returns them. Other libcs/platforms skip the trim
+try:
+    _malloc_trim = ctypes.CDLL("libc.so.6").malloc_trim
+except (OSError, AttributeError):
+    _malloc_trim = None
+# One trim at a time; RSS left after the last one is the baseline for MALLOC_TRIM_GROWTH_MB
+_malloc_trim_lock = threading.Lock()
+_rss_after_trim = 0
+
 # --- Enhancement 2: Optimized Excel Writing ---
-def write_df_to_excel(df, sheet):
+# Excel rejects worksheet names longer than this
+MAX_SHEET_TITLE_LENGTH = 31
+# Style for every written cell; registered once per workbook with add_format
+CELL_FORMAT = {'align': 'center', 'valign': 'vcenter', 'text_wrap': True}
+# constant_memory streams each row to disk as soon as the next row starts;
+# extracted text is written as-is rather than auto-converted to hyperlinks
+WORKBOOK_OPTIONS = {'constant_memory': True, 'strings_to_urls': False}
+
+# In constant_memory mode every worksheet keeps its own temp file open until workbook.close(),
+# so a workbook uses one fd per table (times PDF_JOB_THREADS concurrent jobs). The default
+# soft limit (often 1024) is too low for table-heavy PDFs; raise it to the hard limit
+try:
+    import resource
+    _soft_nofile, _hard_nofile = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if _soft_nofile < _hard_nofile:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (_hard_nofile, _hard_nofile))
+except (ImportError, ValueError, OSError) as e:
+    logger.warning(f"Could not raise the open file limit: {e}")
+
+def _line_lengths(text):
     """
-    Writes a DataFrame to an Excel sheet with optimized width calculation.
+    Length of the longest line in each value of an Arrow string Series (cells wrap on newlines).
+    Plain str.len() covers the common single-line cells in one kernel; only the
+    cells that actually contain a newline are split.
     """
-    df_to_write = df.copy() # Work on a copy
+    lengths = text.str.len().astype(float)
+    multiline = text.str.contains('\n', regex=False)
+    if multiline.any():
+        lengths[multiline] = text[multiline].str.split('\n').explode().str.len().groupby(level=0).max()
+    return lengths
+
+def _column_widths(df, include_header):
+    """
+    Computes Excel column widths from the DataFrame before anything is written,
+    since constant_memory sheets are written strictly top to bottom.
+    Each column's width comes from its longest line, computed with vectorized
+    pandas string ops rather than per cell.
+    """
+    text = df.astype(ARROW_STRING).fillna('')
+    max_lengths = text.apply(lambda col: _line_lengths(col).max()).fillna(0).to_numpy(dtype=float)
+    if include_header:
+        headers = pd.Series(df.columns.map(str), dtype=ARROW_STRING)
+        max_lengths = np.maximum(max_lengths, _line_lengths(headers).to_numpy())
+    # Padding plus a multiplier for wrapped text, with a minimum and maximum width
+    return np.clip((max_lengths + 2) * 1.2, 8, 70).tolist()
+
+def write_df_to_excel(df, sheet, cell_format):
+    """
+    Writes a DataFrame to a constant_memory xlsxwriter worksheet. Column widths are
+    computed from the DataFrame first, then rows are streamed top to bottom with cell_format.
+    """
+    df_to_write = df # Only read below, never mutated, so no copy is needed
 
     if df_to_write.empty:
-        logger.warning(f"DataFrame for sheet '{sheet.title}' is empty, nothing to write.")
+        logger.warning(f"DataFrame for sheet '{sheet.name}' is empty, nothing to write.")
         return
 
     # Optional: Check if first data row is effectively empty and skip if needed
@@ -44,228 +174,319 @@ def write_df_to_excel(df, sheet):
     # Determine if columns look like default indices (0, 1, 2...)
     write_header_row = True
     try:
-        current_cols = df_to_write.columns.tolist()
-        expected_numeric_cols = list(range(len(current_cols)))
-        # Compare as strings for robustness
-        if [str(c) for c in current_cols] == [str(n) for n in expected_numeric_cols]:
-            logger.info(f"Using data rows as headers for sheet '{sheet.title}'")
+        # One vectorized numeric cast of the labels (str first, so '0' and 0 both match)
+        numeric_cols = pd.to_numeric(pd.Series(df_to_write.columns.map(str)).str.strip(), errors='coerce').to_numpy()
+        if np.array_equal(numeric_cols, np.arange(len(numeric_cols), dtype=float)):
+            logger.debug("Using data rows as headers for sheet '%s'", sheet.name)
             write_header_row = False
     except Exception as e:
-        logger.warning(f"Column header check failed for sheet '{sheet.title}': {e}")
+        logger.warning(f"Column header check failed for sheet '{sheet.name}': {e}")
 
-    # --- Optimization: Track max lengths during write ---
-    column_max_lengths = {} # {col_idx: max_len}
+    # Widths are set before any row is written
+    try:
+        for c_idx, width in enumerate(_column_widths(df_to_write, write_header_row)):
+            sheet.set_column(c_idx, c_idx, width)
+    except Exception as e:
+        logger.warning(f"Could not set column widths in sheet '{sheet.name}': {e}")
 
     # Write header if applicable
+    row_idx = 0
     if write_header_row:
-        for c_idx, value in enumerate(df_to_write.columns, 1):
-            cell_value = "" if pd.isna(value) else value
-            cell = sheet.cell(row=1, column=c_idx, value=cell_value)
-            cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            # Track header length
-            try:
-                cell_str = str(cell.value)
-                lines = cell_str.splitlines()
-                cell_max_line_length = max(len(line) for line in lines) if lines else 0
-                column_max_lengths[c_idx] = max(column_max_lengths.get(c_idx, 0), cell_max_line_length)
-            except Exception as e:
-                 logger.warning(f"Error processing header length for sheet {sheet.title}, col {c_idx}: {e}")
-
-
-    # Write data rows
-    start_row = 2 if write_header_row else 1
-    for r_idx_offset, row_data in enumerate(df_to_write.itertuples(index=False)):
-        current_row_idx = start_row + r_idx_offset
-        for c_idx, value in enumerate(row_data, 1):
-            cell_value = "" if pd.isna(value) else value
-            cell = sheet.cell(row=current_row_idx, column=c_idx, value=cell_value)
-            cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            # Track data length
-            try:
-                cell_str = str(cell.value)
-                lines = cell_str.splitlines()
-                cell_max_line_length = max(len(line) for line in lines) if lines else 0
-                column_max_lengths[c_idx] = max(column_max_lengths.get(c_idx, 0), cell_max_line_length)
-            except Exception as e:
-                 logger.warning(f"Error processing cell length for sheet {sheet.title}, row {current_row_idx}, col {c_idx}: {e}")
+        sheet.write_row(row_idx, 0, ["" if pd.isna(value) else value for value in df_to_write.columns], cell_format)
+        row_idx += 1
+
+    # Write data rows: one bulk conversion to plain Python lists, NaN/None already blanked
+    for row_data in df_to_write.to_numpy(dtype=object, na_value='').tolist():
+        sheet.write_row(row_idx, 0, row_data, cell_format)
+        row_idx += 1
+
+# --- Per-page table extraction in worker processes ---
+# Models are loaded once per worker process by _init_page_worker and reused for every page
+_detector = None
+_formatter = None
+
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+def _init_page_worker():
+    global _detector, _formatter
+    torch.set_num_threads(TORCH_THREADS_PER_WORKER)
+    _detector = TableDetector()
+    _formatter = AutoTableFormatter()
+    # Move the long-lived model objects out of the collector's generations so
+    # later collections in this worker don't keep re-walking them
+    gc.freeze()
+    logger.debug("Models initialized in page worker %s.", os.getpid())
+
+def _get_page_pool():
+    """Returns the shared page worker pool, starting it on first use."""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            # spawn rather than fork: torch and pdfium are not fork-safe once initialized
+            _page_pool = ProcessPoolExecutor(
+                max_workers=PDF_PAGE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_page_worker,
+            )
+            logger.info(f"Page worker pool started with {PDF_PAGE_WORKERS} processes.")
+        return _page_pool
+
+def _warm_page_worker():
+    """No-op task used at startup so the worker processes run their initializer (model load) up front."""
+    return os.getpid()
+
+def _shutdown_page_pool():
+    global _page_pool
+    with _page_pool_lock:
+        pool, _page_pool = _page_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _discard_page_pool(pool):
+    """Drops a broken pool (e.g. model load failed or a worker died) so the next request starts a fresh one."""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is pool:
+            _page_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _clean_table_df(df, page_num, table_num):
+    """Normalizes an extracted table's cells and header labels to display strings."""
+    # Convert all to Arrow-backed strings (one contiguous buffer per column instead of a
+    # Python str per cell), blank missing values, then one replace call: blank out
+    # 'None'/'nan' cells and turn literal '\\n' into real line breaks.
+    # fillna must come first: pandas skips dict regex replacements on columns holding <NA>
+    try:
+        df = df.astype(ARROW_STRING).fillna('').replace({_BLANK_CELL_RE: '', _NL_RE: '\n'}, regex=True)
+    except Exception as replace_err:
+        logger.warning(f"Error during string replacement on P{page_num} T{table_num}: {replace_err}")
 
+    # Multi-line headers come back joined with a literal '\\n'; turn them into
+    # real line breaks in one vectorized pass over the column labels
+    if not isinstance(df.columns, pd.MultiIndex):
+        df.columns = df.columns.astype(str).str.replace('\\n', '\n', regex=False)
+    return df
 
-    # Adjust column widths based on tracked max lengths
-    for c_idx, max_length in column_max_lengths.items():
-        try:
-            column_letter = sheet.cell(row=1, column=c_idx).column_letter # Get column letter
-            # Adjust width calculation slightly (padding, max width constraint)
-            # Increased multiplier slightly for wrapped text, ensure minimum width
-            adjusted_width = min(max( (max_length + 2) * 1.2 , 8), 70)
-            sheet.column_dimensions[column_letter].width = adjusted_width
-        except Exception as e:
-            # Catch potential errors like invalid column index if sheet is empty/corrupt
-            logger.warning(f"Could not set width for column index {c_idx} (Letter: {column_letter}) in sheet '{sheet.title}': {e}")
+def _extract_page_tables(pdf_path, page_index):
+    """
+    Runs in a page worker process: detects and formats the tables on one page.
+    Returns a list of (table_num, DataFrame) for the tables that produced data.
+    """
+    page_num = page_index + 1
+    logger.debug("Processing Page %s", page_num)
+    results = []
+    doc = PyPDFium2Document(pdf_path)
+    try:
+        # Inference mode also drops the autograd bookkeeping gmft's own no_grad still does
+        with torch.inference_mode():
+            page = doc.get_page(page_index)
+            tables = _detector.extract(page)
+            if not tables:
+                logger.debug("No tables found on page %s.", page_num)
+                return results
+            logger.debug("Found %s tables on page %s.", len(tables), page_num)
+
+            for table_num, table in enumerate(tables, start=1):
+                logger.debug("Processing Page %s, Table %s", page_num, table_num)
+                try:
+                    formatted_table = _formatter.extract(table)
+                    # Check if formatted_table itself is None or its df is None
+                    if formatted_table is None or formatted_table.df() is None:
+                        logger.warning(f"Formatter returned no data structure for table {table_num} on page {page_num}.")
+                        continue
+
+                    df = formatted_table.df() # Get DataFrame
+                    if df is None or df.empty: # Check again if df is None or empty
+                        logger.debug("Empty DataFrame for table %s on page %s.", table_num, page_num)
+                        continue
+
+                    results.append((table_num, _clean_table_df(df, page_num, table_num)))
+                except Exception as e:
+                    logger.error(f"Error processing table {table_num} on page {page_num}: {str(e)}", exc_info=True)
+
+            # Optional: Explicitly close page object if needed by library
+            try:
+                page.close()
+                logger.debug("Closed page object for page %s", page_num)
+            except Exception as page_close_err:
+                logger.warning(f"Could not close page object for page {page_num}: {page_close_err}")
+    finally:
+        doc.close()
+    return results
 
 # --- Enhancement 1: Synchronous function for CPU-bound work ---
-def _process_pdf(pdf_path):
+def _unique_sheet_title(title, used_titles):
+    """
+    Returns title cut to Excel's limit, with a _N suffix if that name is taken, and records it
+    in used_titles. Truncating first means the dedup check sees exactly the name that gets written.
+    """
+    sheet_title_base = title[:MAX_SHEET_TITLE_LENGTH]
+    sheet_title = sheet_title_base
+    counter = 1
+    while sheet_title in used_titles:
+        suffix = f"_{counter}"
+        sheet_title = sheet_title_base[:MAX_SHEET_TITLE_LENGTH - len(suffix)] + suffix
+        counter += 1
+    used_titles.add(sheet_title)
+    return sheet_title
+
+def _process_pdf(pdf_path, output_path, abandoned=None):
     """
     Synchronous PDF processing function (runs in a separate thread).
-    Loads models internally for simplicity in this example.
-    For higher performance, use lifespan context manager to load models once.
+    Pages are fanned out to the page worker processes; their tables are written
+    to the workbook here, in page order, since a workbook is not thread/process safe.
+    The workbook is saved straight to output_path, which is returned.
+    If the abandoned event is set (the request gave up waiting), the remaining pages are cancelled.
     """
-    logger.info(f"Starting PDF processing for: {pdf_path}")
-    # Initialize models here for simplicity, or pass pre-initialized ones
-    try:
-        detector = TableDetector()
-        formatter = AutoTableFormatter()
-        logger.debug("Models initialized.")
-    except Exception as e:
-        logger.error(f"Failed to initialize models: {e}", exc_info=True)
-        raise RuntimeError(f"Model initialization failed: {e}") from e
+    logger.debug("Starting PDF processing for: %s", pdf_path)
 
-    workbook = Workbook()
-    # Remove default sheet created by Workbook()
-    if "Sheet" in workbook.sheetnames:
-        default_sheet = workbook["Sheet"]
-        workbook.remove(default_sheet)
-        logger.debug("Removed default 'Sheet'.")
+    # Rows are streamed to disk as they are written; the xlsx itself is assembled at close()
+    workbook = xlsxwriter.Workbook(output_path, WORKBOOK_OPTIONS)
+    cell_format = workbook.add_format(CELL_FORMAT)
 
     sheets_added_count = 0
-    doc = None  # Initialize doc to None
+    # Titles already used in this workbook (new workbooks start with no sheets)
+    used_titles = set()
 
     try:
-        # Manually create the document object
+        # Only the page count is needed here; each worker opens the document itself
         doc = PyPDFium2Document(pdf_path)
-        logger.info(f"Opened PDF: {pdf_path}. Processing pages...")
+        try:
+            page_count = len(doc)
+        finally:
+            doc.close()
+        logger.info(f"Opened PDF: {pdf_path}. Processing {page_count} pages...")
+
+        pool = _get_page_pool()
 
-        # Process pages within the try block
-        for page_num, page in enumerate(doc, start=1):
-            logger.debug(f"Processing Page {page_num}")
+        def submit_page(page_index):
             try:
-                tables = detector.extract(page)
-                if not tables:
-                    logger.debug(f"No tables found on page {page_num}.")
-                    continue
-                logger.debug(f"Found {len(tables)} tables on page {page_num}.")
-
-                for table_num, table in enumerate(tables, start=1):
-                    # ... (inner try/except for table processing remains the same) ...
-                    # ... (df cleaning, sheet creation, write_df_to_excel call) ...
-                    logger.debug(f"Processing Page {page_num}, Table {table_num}")
+                return pool.submit(_extract_page_tables, pdf_path, page_index)
+            except BrokenProcessPool as pool_err:
+                _discard_page_pool(pool)
+                raise RuntimeError(f"Page worker pool unavailable: {pool_err}") from pool_err
+
+        # The pool is shared by all jobs, so each job keeps at most PDF_PAGE_WORKERS pages
+        # in flight; submitting a whole PDF at once would queue every other job behind it
+        page_futures = deque(submit_page(page_index) for page_index in range(min(PDF_PAGE_WORKERS, page_count)))
+        next_page_index = len(page_futures)
+
+        # Collect results in page order and write sheets sequentially
+        try:
+            for page_num in range(1, page_count + 1):
+                if abandoned is not None and abandoned.is_set():
+                    raise RuntimeError(f"Request abandoned before page {page_num}")
+                # Popped so the queue doesn't keep this page's DataFrames (the future's result)
+                # alive once they are written
+                page_future = page_futures.popleft()
+                # Refill the window before waiting, so the workers stay busy while this page is written
+                if next_page_index < page_count:
+                    page_futures.append(submit_page(next_page_index))
+                    next_page_index += 1
+                try:
+                    page_tables = page_future.result()
+                except BrokenProcessPool as pool_err:
+                    # Model initialization failed or a worker crashed; no later page can succeed
+                    _discard_page_pool(pool)
+                    raise RuntimeError(f"Page worker pool failed on page {page_num}: {pool_err}") from pool_err
+                except Exception as page_err:
+                     logger.error(f"Error processing page {page_num}: {page_err}", exc_info=True)
+                     continue
+                finally:
+                    del page_future
+
+                while page_tables:
+                    # Popped so the list doesn't keep already-written frames alive
+                    table_num, df = page_tables.pop(0)
                     try:
-                        formatted_table = formatter.extract(table)
-                        # Check if formatted_table itself is None or its df is None
-                        if formatted_table is None or formatted_table.df() is None:
-                            logger.warning(f"Formatter returned no data structure for table {table_num} on page {page_num}.")
-                            continue
-
-                        df = formatted_table.df() # Get DataFrame
-                        if df is None or df.empty: # Check again if df is None or empty
-                            logger.info(f"Empty DataFrame for table {table_num} on page {page_num}.")
-                            continue
-
-                        # Clean data more carefully
-                        df = df.astype(str) # Convert all to string first
-                        df.replace('None', '', inplace=True) # Replace string 'None'
-                        df.replace('nan', '', inplace=True)  # Replace string 'nan'
-                        # Apply newline replacement using vectorized operation if possible
-                        try:
-                            df = df.map(lambda x: x.replace('\\n', '\n') if isinstance(x, str) else x)
-                        except Exception as replace_err:
-                            logger.warning(f"Error during string replacement on P{page_num} T{table_num}: {replace_err}")
-
-
-                        # Create unique sheet title
-                        sheet_title_base = f"Page_{page_num}-Table_{table_num}"
-                        sheet_title = sheet_title_base
-                        counter = 1
-                        while sheet_title in workbook.sheetnames:
-                            sheet_title = f"{sheet_title_base}_{counter}"
-                            counter += 1
-                        
-                        logger.debug(f"Creating sheet: '{sheet_title}'")
-                        sheet = workbook.create_sheet(title=sheet_title)
-                        write_df_to_excel(df, sheet) # Use the optimized function
+                        sheet_title = _unique_sheet_title(f"Page_{page_num}-Table_{table_num}", used_titles)
+                        logger.debug("Creating sheet: '%s'", sheet_title)
+                        sheet = workbook.add_worksheet(sheet_title)
+                        write_df_to_excel(df, sheet, cell_format) # Use the optimized function
                         sheets_added_count += 1
-                        logger.debug(f"Finished writing to sheet: '{sheet_title}'")
-
-                        # Hint garbage collector
-                        del df
-                        del formatted_table
-                        gc.collect()
+                        logger.debug("Finished writing to sheet: '%s'", sheet_title)
 
                     except Exception as e:
                         logger.error(f"Error processing table {table_num} on page {page_num}: {str(e)}", exc_info=True)
-
-                # Optional: Explicitly close page object if needed by library
-                # Check if the real page object has a close method
-                if hasattr(page, 'close') and callable(page.close):
-                     try:
-                         page.close()
-                         logger.debug(f"Closed page object for page {page_num}")
-                     except Exception as page_close_err:
-                         logger.warning(f"Could not close page object for page {page_num}: {page_close_err}")
-
-            except Exception as page_err:
-                 logger.error(f"Error processing page {page_num}: {page_err}", exc_info=True)
+                    # This was the last reference, so refcounting frees the frame here
+                    del df
+        finally:
+            # Pages not yet written (abandoned job, broken pool) are not worth finishing
+            for pending in page_futures:
+                pending.cancel()
 
         logger.info(f"Finished processing all pages for {pdf_path}. Sheets added: {sheets_added_count}")
         # --- END processing loop ---
 
     except Exception as e:
-        # Catch errors during doc opening or page iteration
+        # Catch errors during doc opening or page dispatch
         logger.error(f"Critical error processing PDF '{pdf_path}': {str(e)}", exc_info=True)
         # Let the calling function handle the HTTPException by re-raising
         # Ensure error is wrapped in a standard Exception type if needed, but RuntimeError is okay
+        # close() still releases the per-sheet temp files; the endpoint removes the partial output
+        with suppress(Exception):
+            workbook.close()
         raise RuntimeError(f"PDF processing failed: {e}") from e
-    finally:
-        # --- Ensure doc.close() is always called if doc was created ---
-        if doc and hasattr(doc, 'close') and callable(doc.close):
-            try:
-                doc.close()
-                logger.info(f"Closed PDF document object for: {pdf_path}")
-            except Exception as close_err:
-                logger.error(f"Error closing PDF document object for {pdf_path}: {close_err}", exc_info=True)
 
     # Check if any sheets were added
     if sheets_added_count == 0:
         logger.warning(f"No tables were successfully extracted from {pdf_path}. Creating placeholder sheet.")
         # Ensure there's at least one sheet, even if empty
-        if not workbook.sheetnames:
-            workbook.create_sheet("No Tables Found")
+        if not used_titles:
+            workbook.add_worksheet("No Tables Found")
         # If you prefer to return an error or empty response when no tables are found,
         # you could raise an exception here or return None, and handle it in the endpoint.
 
-    # Save workbook to buffer
-    excel_buffer = io.BytesIO()
+    # close() assembles the xlsx at output_path and releases the sheets' temp files;
+    # the endpoint streams the file back
     try:
-        workbook.save(excel_buffer)
-        logger.info(f"Excel workbook saved to buffer for {pdf_path}.")
+        workbook.close()
+        logger.debug("Excel workbook saved to %s for %s.", output_path, pdf_path)
     except Exception as save_err:
-         logger.error(f"Failed to save workbook to buffer for {pdf_path}: {save_err}", exc_info=True)
+         logger.error(f"Failed to save workbook to {output_path} for {pdf_path}: {save_err}", exc_info=True)
          raise RuntimeError(f"Failed to save Excel file: {save_err}") from save_err
-    finally:
-         # Explicitly close workbook to release resources
-         workbook.close()
-         gc.collect()
 
-    excel_buffer.seek(0)
-    return excel_buffer.getvalue()
+    return output_path
 
-# --- Enhancement 1: Async function using asyncio.to_thread ---
-async def process_pdf_with_timeout(pdf_path: str, timeout: int = 300):
+# --- Enhancement 1: Run the whole PDF job in an executor so the event loop stays free ---
+async def process_pdf_with_timeout(job_files: "_PdfJobFiles", timeout: int = 300):
     """
-    Processes the PDF in a separate thread with a timeout.
-    Manages temporary file cleanup in case of timeout or error within the thread.
+    Processes the staged PDF in a separate thread with a timeout.
+    The job holds job_files until it actually finishes, which after a timeout is later than the request.
     """
-    logger.info(f"Scheduling PDF processing for {pdf_path} with timeout {timeout}s")
+    pdf_path, output_path = job_files.pdf_path, job_files.output_path
+    logger.debug("Scheduling PDF processing for %s with timeout %ss", pdf_path, timeout)
     try:
-        # Runs the synchronous _process_pdf function in a thread pool managed by asyncio
-        result = await asyncio.wait_for(
-            asyncio.to_thread(_process_pdf, pdf_path),
-            timeout=timeout
-        )
-        logger.info(f"Successfully processed PDF in thread: {pdf_path}")
+        # _process_pdf is fully synchronous (page dispatch, sheet writing, workbook.close),
+        # so the entire job runs in the dedicated PDF job pool rather than on the event loop
+        # The slot is held until the job thread really finishes, not just until this request
+        # stops waiting, so a timed-out job still counts against PDF_JOB_THREADS
+        loop = asyncio.get_running_loop()
+        job_slots = app.state.pdf_job_slots
+        await job_slots.acquire()
+        try:
+            job_future = app.state.pdf_pool.submit(_process_pdf, pdf_path, output_path, job_files.abandoned)
+        except BaseException:
+            job_slots.release()
+            raise
+        job_files.acquire()
+
+        def _job_done(_):
+            # Runs when the job finishes, fails, or is cancelled before starting
+            job_files.release()
+            # The loop is gone if the job outlived the application
+            with suppress(RuntimeError):
+                loop.call_soon_threadsafe(job_slots.release)
+
+        job_future.add_done_callback(_job_done)
+        result = await asyncio.wait_for(asyncio.wrap_future(job_future), timeout=timeout)
+        logger.debug("Successfully processed PDF in thread: %s", pdf_path)
         return result
     except asyncio.TimeoutError:
         logger.error(f"Processing timed out after {timeout} seconds for {pdf_path}")
-        # No need to clean up temp file here, it's handled in the main endpoint's finally block
+        # The job thread can't be stopped; it stops at the next page once the request
+        # abandons it, and the staged PDF and any output are removed when it ends
         raise HTTPException(status_code=504, detail=f"Processing timed out after {timeout} seconds. The PDF might be too complex or large.")
     except Exception as e:
         # Catch exceptions raised from within the thread (_process_pdf)
@@ -279,6 +500,137 @@ async def process_pdf_with_timeout(pdf_path: str, timeout: int = 300):
         raise HTTPException(status_code=500, detail=f"PDF processing failed: ({type(e).__name__}) {str(e)}")
 
 
+def _remove_temp_file(path):
+    """Deletes a temporary file, logging (not raising) on failure."""
+    try:
+        os.unlink(path)
+        logger.debug("Temporary file removed: %s", path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # Log if deletion fails, but don't crash the request handling
+        logger.error(f"CRITICAL: Failed to remove temporary file {path}: {e}", exc_info=True)
+
+def _current_rss_bytes():
+    """Current (not peak) resident set size of this process, from /proc/self/statm."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def _trim_heap_if_large():
+    """
+    Calls malloc_trim(0) when RSS is above MALLOC_TRIM_RSS_MB and has grown by
+    MALLOC_TRIM_GROWTH_MB since the last trim, so quiet requests pay nothing.
+    The trim walks the whole heap, so it runs in a worker thread, never on the event loop.
+    """
+    global _rss_after_trim
+    if _malloc_trim is None or not _malloc_trim_lock.acquire(blocking=False):
+        return
+    try:
+        rss = _current_rss_bytes()
+        if rss > MALLOC_TRIM_RSS_MB * 1024 * 1024 and \
+                rss - _rss_after_trim > MALLOC_TRIM_GROWTH_MB * 1024 * 1024:
+            _malloc_trim(0)
+            _rss_after_trim = _current_rss_bytes()
+            logger.debug("malloc_trim: RSS %.0f MB -> %.0f MB", rss / (1024 * 1024), _rss_after_trim / (1024 * 1024))
+    except (OSError, ValueError):
+        pass
+    finally:
+        _malloc_trim_lock.release()
+
+def _open_pdf_staging_file():
+    """
+    Opens a file for staging the uploaded PDF and returns (file object, path, is_named).
+    On Linux it is an O_TMPFILE: an anonymous inode in TEMP_DIR that vanishes when its fd
+    is closed, even if the process dies. The page workers reach it through
+    /proc/<pid>/fd/<fd>. Elsewhere, or if the filesystem lacks O_TMPFILE, it falls back
+    to a NamedTemporaryFile that the caller must unlink.
+    """
+    if hasattr(os, "O_TMPFILE"):
+        try:
+            fd = os.open(TEMP_DIR, os.O_TMPFILE | os.O_RDWR, 0o600)
+        except OSError:
+            pass
+        else:
+            return os.fdopen(fd, "wb+"), f"/proc/{os.getpid()}/fd/{fd}", False
+    temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf", dir=TEMP_DIR)
+    return temp_pdf, temp_pdf.name, True
+
+class _PdfJobFiles:
+    """
+    The staged upload and the output workbook, shared by a request and its PDF job. The page
+    workers open the upload by path, and /proc/<pid>/fd/<fd> names whatever that fd number
+    refers to at the time, so the files are cleaned up only once both holders have released
+    them. The request is the first holder; after a timeout the job is the last one and
+    removes the workbook it wrote after the request gave up. The output is left in place
+    only if keep_output() handed it to a response.
+    """
+    def __init__(self):
+        self.staging_file, self.pdf_path, self._pdf_is_named = _open_pdf_staging_file()
+        self.output_path = os.path.join(TEMP_DIR, f"{uuid.uuid4().hex}.xlsx")
+        # Set when the request stops waiting, so the job skips its remaining pages
+        self.abandoned = threading.Event()
+        self._keep_output = False
+        self._holders = 1
+        self._lock = threading.Lock()
+
+    def keep_output(self):
+        self._keep_output = True
+
+    def acquire(self):
+        with self._lock:
+            self._holders += 1
+
+    def release(self):
+        with self._lock:
+            self._holders -= 1
+            if self._holders:
+                return
+        self.staging_file.close() # Also frees an O_TMPFILE; only the named fallback needs unlinking
+        if self._pdf_is_named:
+            _remove_temp_file(self.pdf_path)
+        if not self._keep_output:
+            _remove_temp_file(self.output_path)
+
+def _file_too_large_error():
+    return HTTPException(
+        status_code=413, # Payload Too Large
+        detail=f"File too large: exceeds limit of {MAX_FILE_SIZE_MB}MB"
+    )
+
+def _copy_upload(src, dst, max_bytes):
+    """
+    Copies an upload into dst in UPLOAD_COPY_CHUNK_SIZE chunks and returns the byte count.
+    Raises HTTPException(413) as soon as more than max_bytes have been read, so an
+    oversized upload is never written out in full.
+    """
+    file_size = 0
+    while chunk := src.read(UPLOAD_COPY_CHUNK_SIZE):
+        file_size += len(chunk)
+        if file_size > max_bytes:
+            raise _file_too_large_error()
+        dst.write(chunk)
+    return file_size
+
+class RejectOversizeUploads:
+    """
+    ASGI middleware for /extract-tables only: a PDF whose Content-Length is already too large gets
+    a 413 before the form is parsed. Other routes, and the FileResponse stream, are not wrapped.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/extract-tables":
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if content_length.isdigit() and int(content_length) > MAX_FILE_SIZE_BYTES + MULTIPART_OVERHEAD_BYTES:
+                logger.warning(f"Upload rejected before reading: Content-Length {content_length.decode()} exceeds limit of {MAX_FILE_SIZE_MB}MB.")
+                exc = _file_too_large_error()
+                await JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(RejectOversizeUploads)
+
 @app.post("/extract-tables", response_class=Response)
 async def extract_tables(file: UploadFile = File(...)):
     """
@@ -289,44 +641,36 @@ async def extract_tables(file: UploadFile = File(...)):
         logger.warning(f"Invalid file upload attempt: {file.filename if file else 'No file'}")
         raise HTTPException(status_code=400, detail="Invalid input: File must be a PDF.")
 
-    temp_pdf_path = None # Initialize path variable
+    # Starlette has already spooled the part and knows its size; reject before touching TEMP_DIR
+    if file.size is not None and file.size > MAX_FILE_SIZE_BYTES:
+        logger.warning(f"File rejected: Size {file.size / (1024 * 1024):.2f}MB exceeds limit of {MAX_FILE_SIZE_MB}MB.")
+        raise _file_too_large_error()
+
+    job_files = None # Initialize file/path variables
     try:
-        # Use a temporary file to handle potentially large uploads efficiently
-        # delete=False is important as we need to pass the path to another thread/process
-        # and manage deletion manually after processing is complete.
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf", dir=TEMP_DIR) as temp_pdf:
-            temp_pdf_path = temp_pdf.name # Store the path
-            logger.info(f"Receiving file: {file.filename}. Saving to temp path: {temp_pdf_path}")
-            
-            # Read file content in chunks and write to temp file
-            file_size = 0
-            chunk_size = 1024 * 1024 # 1MB chunks
-            while True:
-                chunk = await file.read(chunk_size)
-                if not chunk:
-                    break
-                file_size += len(chunk)
-                temp_pdf.write(chunk)
-            
-            file_size_mb = file_size / (1024 * 1024)
-            logger.info(f"Finished writing {file_size_mb:.2f} MB to {temp_pdf_path}")
-
-        # Optional: Add a file size limit check here if needed
-        MAX_FILE_SIZE_MB = 25 # Example limit: 100 MB
-        if file_size_mb > MAX_FILE_SIZE_MB:
-            logger.warning(f"File rejected: Size {file_size_mb:.2f}MB exceeds limit of {MAX_FILE_SIZE_MB}MB.")
-            raise HTTPException(
-                status_code=413, # Payload Too Large
-                detail=f"File too large: {file_size_mb:.2f}MB exceeds limit of {MAX_FILE_SIZE_MB}MB"
-            )
+        # Stage the upload in a temp file; it stays open until both this request and its job
+        # are done, since an O_TMPFILE staging file only exists while its fd is open
+        job_files = _PdfJobFiles()
+        temp_pdf, temp_pdf_path = job_files.staging_file, job_files.pdf_path
+        logger.info(f"Receiving file: {file.filename}. Saving to temp path: {temp_pdf_path}")
+
+        # Copy the upload to the temp file in a worker thread, off the event loop,
+        # in large chunks so a max-size upload takes only a few read/write calls.
+        # The copy stops with 413 once the limit is passed; the finally removes the partial file
+        await file.seek(0)
+        file_size = await run_in_threadpool(_copy_upload, file.file, temp_pdf, MAX_FILE_SIZE_BYTES)
+        # The PDF is reopened by path, so buffered bytes must reach the file first
+        temp_pdf.flush()
+
+        file_size_mb = file_size / (1024 * 1024)
+        logger.debug("Finished writing %.2f MB to %s", file_size_mb, temp_pdf_path)
 
         # Process the temporary file using the threaded function with timeout
-        processing_timeout = 600 # Example: 10 minutes timeout
-        excel_content = await process_pdf_with_timeout(temp_pdf_path, timeout=processing_timeout)
+        excel_path = job_files.output_path
+        await process_pdf_with_timeout(job_files, timeout=PROCESSING_TIMEOUT_SECONDS)
 
-        # Check if content is empty (can happen if _process_pdf decides not to create "No Tables Found")
-        # Adjust this logic based on whether _process_pdf always returns bytes
-        if not excel_content:
+        # Check if the workbook is missing (can happen if _process_pdf decides not to create "No Tables Found")
+        if not os.path.exists(excel_path):
              logger.warning(f"Processing resulted in empty content for {temp_pdf_path}. Returning 204 No Content.")
              # Option: Return 204 No Content if no tables found and no placeholder sheet created
              return Response(status_code=204)
@@ -336,15 +680,18 @@ async def extract_tables(file: UploadFile = File(...)):
         output_filename = f"extracted_{base_filename}.xlsx"
         logger.info(f"Successfully processed {temp_pdf_path}. Sending Excel file: {output_filename}")
 
-        # Return the generated Excel file content
-        return Response(
-            content=excel_content,
+        # Stream the generated Excel file from disk; it is deleted once the response has been sent
+        response = FileResponse(
+            excel_path,
             media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             headers={
                 # Ensure filename is properly encoded for headers
                 "Content-Disposition": f"attachment; filename*=UTF-8''{quote_plus(output_filename)}"
-            }
+            },
+            background=BackgroundTask(_remove_temp_file, excel_path),
         )
+        job_files.keep_output() # Owned by the response's background task now
+        return response
 
     except HTTPException as http_exc:
         # Log HTTP exceptions specifically and re-raise them
@@ -357,16 +704,14 @@ async def extract_tables(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
 
     finally:
-        # --- Crucial: Ensure temporary file is always deleted ---
-        if temp_pdf_path and os.path.exists(temp_pdf_path):
-            try:
-                os.unlink(temp_pdf_path)
-                logger.info(f"Temporary file removed: {temp_pdf_path}")
-            except Exception as e:
-                # Log if deletion fails, but don't crash the request handling
-                logger.error(f"CRITICAL: Failed to remove temporary file {temp_pdf_path}: {e}", exc_info=True)
-        # Hint garbage collection after request potentially involving large data
-        gc.collect()
+        # --- Crucial: Ensure temporary files are always deleted ---
+        if job_files is not None:
+            # If the job is still running it stops early and cleans up after itself
+            job_files.abandoned.set()
+            job_files.release()
+        # Large workbooks leave freed-but-mapped heap behind; give it back to the OS.
+        # Not awaited: the response doesn't depend on it
+        asyncio.get_running_loop().run_in_executor(None, _trim_heap_if_large)
 
 
 @app.get("/health")
@@ -0,0 +1,225 @@
+"""
+Tests for the table extraction service. gmft is replaced by small stubs, so no models
+are loaded, and the page workers run as threads of the test process.
+Run from this directory with: python -m pytest -q
+"""
+import asyncio
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import threading
+import time
+import types
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Released by default; a test clears it to hold every page in the detector
+PAGE_GATE = threading.Event()
+PAGE_GATE.set()
+PAGE_COUNT = 2
+
+
+class _StubDocument:
+    def __init__(self, pdf_path):
+        # Read it like pdfium would, through the staged path
+        with open(pdf_path, "rb") as staged:
+            assert staged.read(5) == b"%PDF-"
+
+    def __len__(self):
+        return PAGE_COUNT
+
+    def get_page(self, page_index):
+        return page_index
+
+    def close(self):
+        pass
+
+
+class _StubDetector:
+    def extract(self, page):
+        PAGE_GATE.wait(10)
+        return [page]
+
+
+class _StubFormattedTable:
+    def df(self):
+        return pd.DataFrame({"Name\\nFull": ["a", None], "Value": ["1", "nan"]})
+
+
+class _StubFormatter:
+    def extract(self, table):
+        return _StubFormattedTable()
+
+
+gmft = types.ModuleType("gmft")
+gmft_auto = types.ModuleType("gmft.auto")
+gmft_auto.TableDetector = _StubDetector
+gmft_auto.AutoTableFormatter = _StubFormatter
+gmft_pdf_bindings = types.ModuleType("gmft.pdf_bindings")
+gmft_pdf_bindings.PyPDFium2Document = _StubDocument
+sys.modules.update({"gmft": gmft, "gmft.auto": gmft_auto, "gmft.pdf_bindings": gmft_pdf_bindings})
+
+# torch is only installed as a gmft dependency
+if importlib.util.find_spec("torch") is None:
+    torch = types.ModuleType("torch")
+    torch.set_num_threads = lambda threads: None
+    torch.inference_mode = contextlib.nullcontext
+    sys.modules["torch"] = torch
+
+from fastapi.testclient import TestClient
+
+import app as app_module
+
+PDF_BYTES = b"%PDF-1.4\n" + b"0" * 4096 + b"\n%%EOF\n"
+
+
+@pytest.fixture(params=["tmpfile", "named"])
+def client(request, monkeypatch):
+    if request.param == "named":
+        # Force the NamedTemporaryFile fallback
+        monkeypatch.delattr(os, "O_TMPFILE", raising=False)
+    # Spawned page workers would import the real gmft; threads share the stubs
+    monkeypatch.setattr(app_module, "_page_pool", ThreadPoolExecutor(
+        max_workers=app_module.PDF_PAGE_WORKERS, initializer=app_module._init_page_worker,
+    ))
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+@pytest.fixture
+def job_files(monkeypatch):
+    created = []
+
+    class RecordingJobFiles(app_module._PdfJobFiles):
+        def __init__(self):
+            super().__init__()
+            created.append(self)
+
+    monkeypatch.setattr(app_module, "_PdfJobFiles", RecordingJobFiles)
+    return created
+
+
+def _files_removed(job):
+    staged_removed = job.staging_file.closed and \
+        not (job._pdf_is_named and os.path.exists(job.pdf_path))
+    return staged_removed and not os.path.exists(job.output_path)
+
+
+def test_extract_tables_returns_workbook_and_removes_temp_files(client, job_files):
+    response = client.post("/extract-tables", files={"file": ("report.pdf", PDF_BYTES, "application/pdf")})
+
+    assert response.status_code == 200, response.text
+    assert response.headers["content-disposition"] == "attachment; filename*=UTF-8''extracted_report.xlsx"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as xlsx:
+        workbook_xml = xlsx.read("xl/workbook.xml").decode()
+    assert 'name="Page_1-Table_1"' in workbook_xml and 'name="Page_2-Table_1"' in workbook_xml
+
+    (job,) = job_files
+    assert _files_removed(job)
+
+
+def test_extract_tables_timeout_removes_temp_files_when_job_ends(client, job_files, monkeypatch):
+    monkeypatch.setattr(app_module, "PROCESSING_TIMEOUT_SECONDS", 0.2)
+    PAGE_GATE.clear()
+    try:
+        response = client.post("/extract-tables", files={"file": ("report.pdf", PDF_BYTES, "application/pdf")})
+
+        assert response.status_code == 504, response.text
+        (job,) = job_files
+        # The job outlives the request and still holds the staged PDF
+        assert not job.staging_file.closed
+    finally:
+        PAGE_GATE.set()
+
+    deadline = time.monotonic() + 10
+    while not _files_removed(job) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert _files_removed(job)
+
+
+def test_clean_table_df_blanks_missing_cells_and_converts_line_breaks():
+    df = pd.DataFrame(
+        [[None, "nan", "not None"], ["a\\nb", np.nan, "x"]],
+        columns=["Header\\nTwo", "B", "C"],
+    )
+
+    cleaned = app_module._clean_table_df(df, page_num=1, table_num=1)
+
+    assert cleaned.columns.tolist() == ["Header\nTwo", "B", "C"]
+    assert cleaned.astype(object).values.tolist() == [["", "", "not None"], ["a\nb", "", "x"]]
+
+
+def test_column_widths_use_longest_line_of_multi_line_cells():
+    df = pd.DataFrame({
+        "A": ["short", "a longer line\nab"],
+        "Wide header\nB": ["x", "y"],
+        "C": ["", ""],
+    })
+
+    without_header = app_module._column_widths(df, include_header=False)
+    with_header = app_module._column_widths(df, include_header=True)
+
+    # (longest line + 2) * 1.2, clipped to [8, 70]
+    assert without_header == pytest.approx([(13 + 2) * 1.2, 8, 8])
+    assert with_header == pytest.approx([(13 + 2) * 1.2, (11 + 2) * 1.2, 8])
+
+
+def test_column_widths_are_capped():
+    df = pd.DataFrame({"A": ["x" * 200]})
+
+    assert app_module._column_widths(df, include_header=False) == [70]
+
+
+def test_unique_sheet_title_truncates_before_deduplicating():
+    used_titles = set()
+    title = "Page_1234567890123-Table_1234567890"
+
+    first = app_module._unique_sheet_title(title, used_titles)
+    second = app_module._unique_sheet_title(title, used_titles)
+
+    assert first == title[:app_module.MAX_SHEET_TITLE_LENGTH]
+    assert second == title[:app_module.MAX_SHEET_TITLE_LENGTH - 2] + "_1"
+    assert used_titles == {first, second}
+
+
+def _call_upload_guard(path, content_length):
+    """Runs RejectOversizeUploads around an app that records whether it was reached."""
+    reached, sent = [], []
+
+    async def inner_app(scope, receive, send):
+        reached.append(scope["path"])
+
+    async def receive():
+        raise AssertionError("the request body must not be read")
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path,
+             "headers": [(b"content-length", str(content_length).encode())]}
+    asyncio.run(app_module.RejectOversizeUploads(inner_app)(scope, receive, send))
+    return reached, sent
+
+
+def test_upload_guard_rejects_oversize_content_length():
+    reached, sent = _call_upload_guard("/extract-tables", app_module.MAX_FILE_SIZE_BYTES * 2)
+
+    assert reached == []
+    assert sent[0]["status"] == 413
+
+
+@pytest.mark.parametrize("path, content_length", [
+    ("/extract-tables", 1024),
+    ("/health", 10 ** 12),
+])
+def test_upload_guard_passes_other_requests_through(path, content_length):
+    reached, sent = _call_upload_guard(path, content_length)
+
+    assert reached == [path]
+    assert sent == []